@@ -4,11 +4,15 @@ from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+import diskcache
+from lxml import etree
+import io
 import os
 import re
 import logging
-from datetime import datetime
+import random
+import threading
+from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -30,6 +34,21 @@ app = Flask(__name__)
 
 # 全局變數
 cleaned_df = None
+data_updated_at = None
+
+# 定時更新間隔
+UPDATE_INTERVAL = timedelta(hours=24)
+# 各 worker 更新時間的隨機延遲上限，避免同時送出請求
+UPDATE_JITTER = timedelta(minutes=10)
+
+
+# 搜尋結果快取，資料更新時清空
+RESPONSE_CACHE_SIZE = 256
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
+# 各月份與地區的預先格式化回應，資料更新時重建
+precomputed_responses = {}
 
 # 載入環境變數
 CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')
@@ -39,6 +58,53 @@ CHANNEL_SECRET = os.getenv('CHANNEL_SECRET')
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
+# 訊息指令判斷
+_DATE_RE = re.compile(r'^\d{6}$')
+_REGION_RE = re.compile(r'^[1-5]$')
+NO_RESPONSE_TEXTS = frozenset({
+    "依時間查詢賽事",
+    "依地區查詢賽事",
+    "依賽事名稱查詢"
+})
+
+# 賽事頁面的磁碟快取 (ETag, Last-Modified, 原始資料)，首次使用時才建立
+# 快取鍵包含解析版本，修改解析邏輯時需遞增 PARSER_VERSION，避免沿用舊解析結果
+PARSER_VERSION = 2
+CACHE_DIR = os.getenv('MARATHON_CACHE_DIR') or os.path.join(
+    os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'taiwan_marathon_linebot'
+)
+_cache = None
+
+def _get_cache():
+    """取得磁碟快取，無法建立時回傳 None"""
+    global _cache
+    if _cache is None:
+        try:
+            _cache = diskcache.Cache(CACHE_DIR)
+        except Exception as e:
+            logger.warning(f"無法建立磁碟快取: {str(e)}")
+    return _cache
+
+def _read_cache(key):
+    """讀取快取，失敗時視為沒有快取"""
+    try:
+        cache = _get_cache()
+        if cache is not None:
+            return cache.get(key, (None, None, None))
+    except Exception as e:
+        logger.warning(f"讀取磁碟快取失敗: {str(e)}")
+    return None, None, None
+
+def _write_cache(key, value):
+    """寫入快取，失敗時僅記錄"""
+    try:
+        cache = _get_cache()
+        if cache is not None:
+            cache.set(key, value)
+    except Exception as e:
+        logger.warning(f"寫入磁碟快取失敗: {str(e)}")
+
 def create_session():
     """創建具有重試機制的會話"""
     session = requests.Session()
@@ -49,47 +115,81 @@ def create_session():
     )
     session.mount('http://', HTTPAdapter(max_retries=retries))
     session.mount('https://', HTTPAdapter(max_retries=retries))
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    })
     return session
 
+# 共用的爬蟲會話，保留連線以供定時更新重複使用
+SESSION = create_session()
+
+def _text(element):
+    """取得元素內所有文字"""
+    return ''.join(element.itertext()).strip()
+
+def _is_race_row(element):
+    """是否為賽事資料列"""
+    return 'rowbackgroundcolor' in (element.get('class') or '').split()
+
 def scrape_marathon_data():
     """爬取馬拉松資料"""
     url = 'http://www.taipeimarathon.org.tw/contest.aspx'
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
     
     try:
-        session = create_session()
-        response = session.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        races = []
-        race_rows = soup.find_all('tr', class_='rowbackgroundcolor')
+        cache_key = (url, PARSER_VERSION)
+        etag, last_modified, cached_df = _read_cache(cache_key)
+        headers = {}
+        if cached_df is not None:
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
         
-        for row in race_rows:
-            cells = row.find_all('td')
-            if len(cells) >= 7:
-                name_cell = cells[1]
-                link_tag = name_cell.find('a')
-                name = link_tag.text.strip() if link_tag else name_cell.text.strip()
-                link = link_tag.get('href', "無資料") if link_tag else "無資料"
-                
-                # 提取報名日期
-                registration_date = cells[7].text.strip() if len(cells) > 7 else "無資料"
-                
-                race_info = {
-                    'date': cells[3].text.strip(),
-                    'name': name,
-                    'location': cells[4].text.strip(),
-                    'distance': cells[5].text.strip(),
-                    'link': link,
-                    'registration_date': registration_date
-                }
-                races.append(race_info)
+        response = SESSION.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached_df is not None:
+            logger.info("賽事頁面未變更，使用快取資料")
+            return cached_df.copy()
+        response.raise_for_status()
+        dates, names, locations, distances, links, registration_dates = [], [], [], [], [], []
+        # 逐列串流解析，處理完即釋放，不建立完整 DOM
+        context = etree.iterparse(io.BytesIO(response.content), tag='tr', html=True, encoding='utf-8')
+        for _, row in context:
+            if _is_race_row(row):
+                cells = row.findall('td')
+                if len(cells) >= 7:
+                    name_cell = cells[1]
+                    link_tag = name_cell.find('.//a')
+                    name = _text(link_tag) if link_tag is not None else _text(name_cell)
+                    link = link_tag.get('href', "無資料") if link_tag is not None else "無資料"
+                    
+                    # 提取報名日期
+                    registration_date = _text(cells[7]) if len(cells) > 7 else "無資料"
+                    
+                    dates.append(_text(cells[3]))
+                    names.append(name)
+                    locations.append(_text(cells[4]))
+                    distances.append(_text(cells[5]))
+                    links.append(link)
+                    registration_dates.append(registration_date)
+            
+            # 賽事列內巢狀的 tr 會先結束，須保留至外層賽事列解析完畢才能釋放
+            if any(_is_race_row(ancestor) for ancestor in row.iterancestors('tr')):
+                continue
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
         
-        return pd.DataFrame(races)
+        df = pd.DataFrame({
+            'date': pd.array(dates, dtype='string[pyarrow]'),
+            'name': pd.array(names, dtype='string[pyarrow]'),
+            'location': pd.array(locations, dtype='string[pyarrow]'),
+            'distance': pd.array(distances, dtype='string[pyarrow]'),
+            'link': pd.array(links, dtype='string[pyarrow]'),
+            'registration_date': pd.array(registration_dates, dtype='string[pyarrow]')
+        })
+        if not df.empty:
+            _write_cache(cache_key, (response.headers.get('ETag'), response.headers.get('Last-Modified'), df))
+        return df
     
     except Exception as e:
         logger.error(f"爬取過程發生錯誤: {str(e)}")
@@ -101,22 +201,27 @@ def clean_data(df):
         if df.empty:
             return df
         
-        # 地區代碼映射
-        location_mapping = {
-            '台北': 1, '臺北': 1, '新北': 1, '基隆': 1, '桃園': 1, '新竹': 1, '宜蘭': 1,
-            '台中': 2, '臺中': 2, '苗栗': 2, '彰化': 2, '南投': 2, '雲林': 2,
-            '高雄': 3, '台南': 3, '臺南': 3, '嘉義': 3, '屏東': 3,
-            '花蓮': 4, '台東': 4, '臺東': 4,
-            '金門': 5, '澎湖': 5, '馬祖': 5
+        # 地區代碼對應的縣市 (依代碼順序比對，先符合者優先)
+        region_patterns = {
+            1: '台北|臺北|新北|基隆|桃園|新竹|宜蘭',
+            2: '台中|臺中|苗栗|彰化|南投|雲林',
+            3: '高雄|台南|臺南|嘉義|屏東',
+            4: '花蓮|台東|臺東',
+            5: '金門|澎湖|馬祖'
         }
         
         # 添加地區代碼
-        df['region_code'] = df['location'].apply(
-            lambda x: next((code for loc, code in location_mapping.items() if loc in x), 0)
-        )
+        df['region_code'] = 0
+        for code, pattern in region_patterns.items():
+            mask = df['location'].str.contains(pattern, regex=True, na=False) & (df['region_code'] == 0)
+            df.loc[mask, 'region_code'] = code
         
         # 從日期欄位提取月份 (格式為 MM/DD)
-        df['month'] = df['date'].str.extract(r'(\d{2})/\d{2}')[0]
+        df['month'] = df['date'].str.slice(0, 2)
+        
+        # 預先轉小寫供關鍵字搜尋使用
+        df['_name_lc'] = df['name'].str.lower()
+        df['_loc_lc'] = df['location'].str.lower()
         
         return df
     
@@ -126,11 +231,19 @@ def clean_data(df):
 
 def update_data():
     """更新數據"""
-    global cleaned_df
+    global cleaned_df, precomputed_responses, data_updated_at
     try:
         raw_df = scrape_marathon_data()
-        if not raw_df.empty:
-            cleaned_df = clean_data(raw_df)
+        new_df = clean_data(raw_df)
+        if not new_df.empty:
+            # 新資料處理完成後才替換，查詢中的請求仍使用原本的資料
+            new_responses = precompute_responses(new_df)
+            # 替換資料與清空快取需在同一鎖內完成，避免回傳舊資料的快取結果
+            with _response_cache_lock:
+                cleaned_df = new_df
+                precomputed_responses = new_responses
+                data_updated_at = datetime.now()
+                _response_cache.clear()
             logger.info("數據更新成功")
         else:
             logger.warning("數據更新失敗：獲取到空的數據框架")
@@ -142,25 +255,31 @@ def format_response(results):
     if results.empty:
         return "找不到符合的賽事"
     
-    response = "找到以下賽事：\n\n"
-    for _, row in results.iterrows():
-        response += f"📅 {row['date']}\n"
-        response += f"🏃 {row['name']}\n"
-        response += f"📍 {row['location']}\n"
-        response += f"🏃‍♂️ {row['distance']}\n"
-        if row['link'] != "無資料":
-            response += f"🔗 {row['link']}\n"
-        if row['registration_date'] != "無資料":
-            response += f"⏰ {row['registration_date']}\n"
-        response += "\n"
+    links = ("🔗 " + results['link'] + "\n").where(results['link'] != "無資料", "")
+    registrations = ("⏰ " + results['registration_date'] + "\n").where(results['registration_date'] != "無資料", "")
+    blocks = (
+        "📅 " + results['date'] + "\n"
+        + "🏃 " + results['name'] + "\n"
+        + "📍 " + results['location'] + "\n"
+        + "🏃‍♂️ " + results['distance'] + "\n"
+        + links
+        + registrations
+    )
     
-    return response
+    return "找到以下賽事：\n\n" + "\n".join(blocks.tolist()) + "\n"
 
 def search_races(df, search_type, value):
     """統一的搜尋函數"""
     if df is None or df.empty:
         return "目前沒有可用的賽事資料"
     
+    cache_key = (search_type, value)
+    with _response_cache_lock:
+        # 快取只對應目前的資料，其他資料框架照常搜尋
+        cached = _response_cache.get(cache_key) if df is cleaned_df else None
+    if cached is not None:
+        return cached
+    
     try:
         if search_type == 'date':
             # 從輸入值中提取月份
@@ -169,19 +288,39 @@ def search_races(df, search_type, value):
         elif search_type == 'region':
             results = df[df['region_code'] == int(value)]
         elif search_type == 'keyword':
+            keyword = value.lower()
             results = df[
-                df['name'].str.contains(value, na=False, case=False) |
-                df['location'].str.contains(value, na=False, case=False)
+                df['_name_lc'].str.contains(keyword, na=False, regex=False) |
+                df['_loc_lc'].str.contains(keyword, na=False, regex=False)
             ]
         else:
             return "無效的搜尋類型"
         
-        return format_response(results)
+        result = format_response(results)
+        with _response_cache_lock:
+            # 僅快取以目前資料計算的結果，避免更新後寫入舊資料
+            if df is cleaned_df:
+                if len(_response_cache) >= RESPONSE_CACHE_SIZE:
+                    _response_cache.pop(next(iter(_response_cache)))
+                _response_cache[cache_key] = result
+        return result
     
     except Exception as e:
         logger.error(f"搜尋過程發生錯誤: {str(e)}")
         return "搜尋過程發生錯誤，請稍後再試"
 
+def precompute_responses(df):
+    """預先產生各月份與地區代碼的回應訊息"""
+    if df is None or df.empty:
+        return {}
+    
+    responses = {}
+    for month, positions in df.groupby('month', sort=False).indices.items():
+        responses[('date', month)] = format_response(df.take(positions))
+    for code, positions in df.groupby('region_code', sort=False).indices.items():
+        responses[('region', int(code))] = format_response(df.take(positions))
+    return responses
+
 @app.route("/callback", methods=['POST'])
 def callback():
     """處理 LINE Webhook"""
@@ -201,12 +340,7 @@ def handle_message(event):
     text = event.message.text.strip()
     
     # 檢查是否為不需回應的特定文字
-    no_response_texts = [
-        "依時間查詢賽事",
-        "依地區查詢賽事",
-        "依賽事名稱查詢"
-    ]
-    if text in no_response_texts:
+    if text in NO_RESPONSE_TEXTS:
         return
     
     try:
@@ -230,12 +364,12 @@ def handle_message(event):
                 result = search_races(cleaned_df, 'keyword', keyword)
         
         # 處理日期搜尋 (YYYYMM 格式)
-        elif re.match(r'^\d{6}$', text):
-            result = search_races(cleaned_df, 'date', text)
+        elif _DATE_RE.match(text):
+            result = precomputed_responses.get(('date', text[-2:])) or search_races(cleaned_df, 'date', text)
         
         # 處理地區代碼搜尋 (1-5)
-        elif re.match(r'^[1-5]$', text):
-            result = search_races(cleaned_df, 'region', text)
+        elif _REGION_RE.match(text):
+            result = precomputed_responses.get(('region', int(text))) or search_races(cleaned_df, 'region', text)
         
         # 說明訊息
         else:
@@ -271,33 +405,43 @@ def handle_message(event):
 
 def init_data():
     """初始化數據"""
-    global cleaned_df
+    global cleaned_df, precomputed_responses, data_updated_at
     try:
         raw_df = scrape_marathon_data()
         if not raw_df.empty:
             cleaned_df = clean_data(raw_df)
+            precomputed_responses = precompute_responses(cleaned_df)
+            data_updated_at = datetime.now()
             logger.info("數據初始化成功")
         else:
             cleaned_df = pd.DataFrame(columns=['date', 'name', 'location', 'distance', 'link', 'region_code', 'month', 'registration_date'])
             logger.warning("使用空的數據框架初始化")
-        
-        # 設置定時更新
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(update_data, 'interval', hours=24)
-        scheduler.start()
     
     except Exception as e:
         logger.error(f"數據初始化失敗: {str(e)}")
         cleaned_df = pd.DataFrame(columns=['date', 'name', 'location', 'distance', 'link', 'region_code', 'month', 'registration_date'])
 
+def start_scheduler():
+    """設置定時更新，沿用的資料已超過更新間隔時立即更新"""
+    now = datetime.now()
+    next_run_time = now if data_updated_at is None else max(now, data_updated_at + UPDATE_INTERVAL)
+    next_run_time += timedelta(seconds=random.uniform(0, UPDATE_JITTER.total_seconds()))
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        update_data, 'interval',
+        seconds=UPDATE_INTERVAL.total_seconds(),
+        jitter=int(UPDATE_JITTER.total_seconds()),
+        next_run_time=next_run_time
+    )
+    scheduler.start()
+    return scheduler
+
 @app.route("/")
 def hello():
     return 'Hello, World!'
 
 if __name__ == "__main__":
     init_data()
+    start_scheduler()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
-else:
-    # 確保在 production 環境中也能初始化數據
-    init_data()
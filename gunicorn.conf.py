@@ -0,0 +1,18 @@
+# gunicorn 設定：在 master 預先載入 app 並爬取一次資料，
+# fork 出的 worker 直接共用已初始化的 cleaned_df
+preload_app = True
+
+
+def when_ready(server):
+    """master 啟動完成、建立 worker 之前初始化數據"""
+    import app
+    app.init_data()
+    # 關閉 master 的連線池，避免 fork 出的 worker 共用同一條連線
+    app.SESSION.close()
+
+
+def post_fork(server, worker):
+    """每個 worker 各自持有一份數據，需各自啟動定時更新；
+    重新建立的 worker 沿用 master 的舊資料，已過期時會立即更新"""
+    import app
+    app.start_scheduler()